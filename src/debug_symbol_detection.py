@@ -20,11 +20,11 @@ import os
 import tempfile
 
 import cv2
-import numpy
 from PIL import Image, ImageDraw
 
 from classify import detect_map_symbols
 from threshold import threshold
+from util import bilevel_to_array
 
 
 COLORS = {
@@ -47,7 +47,7 @@ if __name__ == "__main__":
         with Image.open(thresholded_path) as thresholded:
             for page_num in range(thresholded.n_frames):
                 thresholded.seek(page_num)
-                page = numpy.asarray(thresholded).astype(numpy.uint8) * 255
+                page = bilevel_to_array(thresholded)
                 symbols = detect_map_symbols(page)
                 print(f"page {page_num + 1}: found {len(symbols)} symbols")
                 image = thresholded.convert("RGB")
@@ -9,8 +9,9 @@
 # contains the pieces that are specific to the Zürich project.
 
 import argparse
+import concurrent.futures
 import csv
-import io
+import functools
 import json
 import os
 import re
@@ -24,13 +25,13 @@ from datetime import datetime, timezone
 import cv2
 import numpy
 import PIL.Image
-import quads
 
 from classify import detect_map_symbols
+from quadtree import QuadTree
 from threshold import threshold
+from util import bilevel_to_array, read_csv
 
 Mutation = namedtuple("Mutation", "id date min_x max_x min_y max_y")
-Parcel = namedtuple("Parcel", "id min_x max_x min_y max_y")
 DeletedPoint = namedtuple(
     "DeletedPoint",
     "id symbol x y created_by deleted_by",
@@ -82,8 +83,13 @@ DELETED_POINT_SYMBOLS = {
 # intentionally do not look for GEOS Pro identifiers such as "27123",
 # since these numbers also occur in other context (not as parcel
 # identifiers) in the mutation files.
+#
+# The neighborhood prefixes are AA, AF, AL, AR, AU, EN, FL, HG, HI, HO,
+# LE, OB, OE, RI, SE, SW, UN, WD, WI, WO and WP. In the pattern, they are
+# grouped by first letter, which lets the regular expression engine test
+# a character class instead of trying each alternative in turn.
 PARCEL_RE = re.compile(
-    r"\s((AA|AF|AL|AR|AU|EN|FL|HG|HI|HO|LE|OB|OE|RI|SE|SW|UN|WD|WI|WO|WP)\d{1,4})\s"
+    r"\s((?:A[AFLRU]|EN|FL|H[GIO]|LE|O[BE]|RI|S[EW]|UN|W[DIOP])\d{1,4})\s"
 )
 
 
@@ -91,11 +97,51 @@ PARCEL_RE = re.compile(
 PLAN_SCALE_RE = re.compile(r"\b1\s*:\s*(100|200|250|500|1000|2000)\b")
 
 
+# Metadata of all pages in a TIFF file, as stored by src/render.py
+# in the ImageDescription tag. We parse the metadata only once,
+# instead of seeking through the file whenever we need it.
+class TiffMeta(object):
+    def __init__(self, tiff):
+        self.json = []
+        for page_num in range(tiff.n_frames):
+            tiff.seek(page_num)
+            self.json.append(tiff.tag_v2[270])
+        tiff.seek(0)
+        self.pages = [json.loads(j) for j in self.json]
+
+    # The set of parcels that were created by the mutation,
+    # taken from the metadata of all pages.
+    @functools.cached_property
+    def parcels(self):
+        parcels = set()
+        for meta in self.pages:
+            parcels.update(meta.get("parcels", []))
+        return parcels
+
+
+# Bounding boxes of all parcels in the survey data. Rather than keeping
+# a namedtuple for each of the parcels in Zürich, we store the boxes
+# in a single NumPy array with columns (min_x, max_x, min_y, max_y),
+# plus a dict that maps parcel ids to array rows.
+class ParcelTable(object):
+    def __init__(self, ids, boxes):
+        self.index = {id: row for row, id in enumerate(ids)}
+        self.boxes = numpy.array(boxes, dtype=numpy.float64).reshape((-1, 4))
+
+    # Returns the bounding boxes of those given parcels that are known
+    # to the survey data, as an array with one row per parcel.
+    def bboxes(self, parcels):
+        rows = [r for p in parcels if (r := self.index.get(p)) is not None]
+        return self.boxes[rows]
+
+
 class Georeferencer(object):
     def __init__(self, cadaref_tool, out_dir):
         self.cadaref_tool = cadaref_tool
         self.out_dir = "georeferenced"
         os.makedirs(self.out_dir, exist_ok=True)
+        os.makedirs("thresholded", exist_ok=True)
+        os.makedirs("tmp", exist_ok=True)
         self.deleted_points = self._read_deleted_points()
         self.mutations = self._read_mutations()
         self.parcels = self._read_parcels()
@@ -112,25 +158,48 @@ class Georeferencer(object):
             return
 
         print(f"georeferencing {mutation}")
-        log = io.StringIO()
+        # We write the log to a temporary file (with a different name),
+        # which is not an atomic operation and could be interrupted.
+        # Once the log file is completely written to disk, we rename
+        # the temporary file to the final file name in an atomic operation.
+        # This ensures we don't end up with partially written log files.
+        # Since we stream the log to disk instead of collecting it
+        # in memory, memory use stays bounded however much cadaref prints.
+        tmp_path = log_path + ".tmp"
+        try:
+            with open(tmp_path, "w", buffering=1 << 16) as log:
+                self._georeference(mutation, log)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.rename(tmp_path, log_path)
+
+    def _georeference(self, mutation, log):
         rendered_path = os.path.join("rendered", f"{mutation}.tif")
-        thresholded_path = os.path.join("thresholded", f"{mutation}.tif")
-        if not os.path.exists(thresholded_path):
-            threshold(rendered_path, thresholded_path)
+        thresholded_path = self.threshold(mutation)
         with open(os.path.join("rendered", f"{mutation}.txt")) as fp:
             ocr_text = fp.read()
-            ocr_parcels = set([m[0] for m in PARCEL_RE.findall(ocr_text)])
+            ocr_parcels = {m.group(1) for m in PARCEL_RE.finditer(ocr_text)}
             ocr_scales = self._extract_scales(ocr_text)
             screenshots = self._screenshot_pages(ocr_text)
         num_plans = 0
         with PIL.Image.open(rendered_path) as rend:
             with PIL.Image.open(thresholded_path) as thresh:
-                bbox = self._mutation_bbox(mutation, thresh, ocr_parcels)
+                # The approximate location is the same for all pages
+                # of the mutation, so we compute it only once.
+                tiff_meta = TiffMeta(thresh)
+                bbox = self._mutation_bbox(tiff_meta, ocr_parcels)
+                if bbox:
+                    min_x, max_x, min_y, max_y = bbox
+                    bbox_width, bbox_height = max_x - min_x, max_y - min_y
+                    center_x = min_x + bbox_width / 2
+                    center_y = min_y + bbox_height / 2
                 for page_num in range(thresh.n_frames):
                     rend.seek(page_num)
                     thresh.seek(page_num)
-                    meta_json = thresh.tag_v2[270]
-                    meta = json.loads(meta_json)
+                    meta_json = tiff_meta.json[page_num]
+                    meta = tiff_meta.pages[page_num]
                     page_key = self._page_key(meta)
                     start_time = datetime.now(timezone.utc)
                     start_timestamp = start_time.isoformat()
@@ -176,22 +245,19 @@ class Georeferencer(object):
                     else:
                         width_m = (width_cm / 100.0) * 2000
                         height_m = (height_cm / 100.0) * 2000
-                    min_x, max_x, min_y, max_y = bbox
-                    width_m = max(width_m, max_x - min_x)
-                    height_m = max(height_m, max_y - min_y)
-                    center_x = min_x + (max_x - min_x) / 2
-                    center_y = min_y + (max_y - min_y) / 2
+                    width_m = max(width_m, bbox_width)
+                    height_m = max(height_m, bbox_height)
 
                     # We don't know the plan rotation, so we take the max
                     # of width and height. Typical search radius is ~3.5 km.
                     search_radius = max(width_m, height_m) / 2
-                    search_bbox = quads.BoundingBox(
-                        min_x=center_x - search_radius,
-                        max_x=center_x + search_radius,
-                        min_y=center_y - search_radius,
-                        max_y=center_y + search_radius,
+                    search_bbox = (
+                        center_x - search_radius,
+                        center_x + search_radius,
+                        center_y - search_radius,
+                        center_y + search_radius,
                     )
-                    points = self.quad_tree.within_bb(search_bbox)
+                    points = self.quad_tree.within_bbox(*search_bbox)
                     log.write(f"search_radius: {search_radius}\n")
                     log.write(f"search_bbox: {search_bbox}\n")
                     log.write("num_points: %d\n" % len(points))
@@ -255,7 +321,18 @@ class Georeferencer(object):
         end_time = datetime.now(timezone.utc)
         end_timestamp = end_time.isoformat()
         log.write(f"end_timestamp: {end_timestamp}\n")
-        self._write_log(mutation, log.getvalue())
+
+    # Compute the thresholded image for a mutation, unless it already
+    # exists. This gets called from a background thread to prepare the
+    # next mutation while the current one is being georeferenced.
+    def threshold(self, mutation):
+        path = os.path.join("thresholded", f"{mutation}.tif")
+        if os.path.exists(path):
+            return path
+        in_path = os.path.join("rendered", f"{mutation}.tif")
+        threshold(in_path, "tmp", path + ".tmp")  # not atomic
+        os.rename(path + ".tmp", path)  # atomic
+        return path
 
     # Compute a look-up key for a scanned page from a metadata record,
     # for example:
@@ -287,10 +364,10 @@ class Georeferencer(object):
             for p in points:
                 writer.writerow(
                     {
-                        "id": p.data.id,
-                        "x": p.data.x,
-                        "y": p.data.y,
-                        "symbol": p.data.symbol,
+                        "id": p.id,
+                        "x": p.x,
+                        "y": p.y,
+                        "symbol": p.symbol,
                     }
                 )
 
@@ -304,18 +381,6 @@ class Georeferencer(object):
             for x, y, symbol in symbols:
                 writer.writerow({"x": x, "y": y, "symbol": symbol})
 
-    def _write_log(self, mutation, message):
-        # We write the log to a temporary file (with a different name),
-        # which is not an atomic operation and could be interrupted.
-        # Once the log file is completely written to disk, we rename
-        # the temporary file to the final file name in an atomic operation.
-        # This ensures we don't end up with partially written log files.
-        log_path = os.path.join(self.out_dir, f"{mutation}.log")
-        tmp_path = log_path + ".tmp"
-        with open(tmp_path, "w") as f:
-            f.write(message)
-        os.rename(tmp_path, log_path)
-
     def _read_mutations(self):
         points, dates = {}, {}
         for p in self.deleted_points:
@@ -324,62 +389,59 @@ class Georeferencer(object):
             if p.deleted_by is not None:
                 points.setdefault(p.deleted_by, []).append((p.x, p.y))
         with open("survey_data/mutations.csv") as fp:
-            for r in csv.DictReader(fp):
-                id = r["mutation"]
-                if date := r["date"]:
+            columns = ("mutation", "date", "min_x", "max_x", "min_y", "max_y")
+            for id, date, min_x, max_x, min_y, max_y in read_csv(fp, columns):
+                if date:
                     dates[id] = date
-                min_x, min_y = r["min_x"], r["min_y"]
                 pts = points.setdefault(id, [])
                 if min_x and min_y:
                     pts.append((float(min_x), float(min_y)))
-                max_x, max_y = r["max_x"], r["max_y"]
                 if max_x and max_y:
                     pts.append((float(max_x), float(max_y)))
         mutations = {}
         mutation_ids = set(dates.keys()).union(points.keys())
         for id in mutation_ids:
-            pts = points[id]
-            mutations[id] = Mutation(
-                id=id,
-                date=dates.get(id),
-                min_x=min(x for x, _y in pts) if pts else None,
-                max_x=max(x for x, _y in pts) if pts else None,
-                min_y=min(y for _x, y in pts) if pts else None,
-                max_y=max(y for _x, y in pts) if pts else None,
-            )
+            if pts := points[id]:
+                xs, ys = zip(*pts)
+                bbox = (min(xs), max(xs), min(ys), max(ys))
+            else:
+                bbox = (None, None, None, None)
+            mutations[id] = Mutation(id, dates.get(id), *bbox)
         return mutations
 
     @staticmethod
     def _read_parcels():
-        parcels = {}
+        ids, boxes = [], []
         with open("survey_data/parcels.csv") as fp:
-            for r in csv.DictReader(fp):
-                id = r["parcel"]
-                if r["min_x"] != "":
-                    parcels[id] = Parcel(
-                        id=id,
-                        min_x=float(r["min_x"]),
-                        max_x=float(r["max_x"]),
-                        min_y=float(r["min_y"]),
-                        max_y=float(r["max_y"]),
-                    )
-        return parcels
+            columns = ("parcel", "min_x", "max_x", "min_y", "max_y")
+            for id, min_x, max_x, min_y, max_y in read_csv(fp, columns):
+                if min_x != "":
+                    ids.append(id)
+                    boxes.append((min_x, max_x, min_y, max_y))
+        return ParcelTable(ids, boxes)
 
     @staticmethod
     def _read_deleted_points():
         points = []
         path = os.path.join(os.path.dirname(__file__), "deleted_points.csv")
         with open(path) as fp:
-            for rec in csv.DictReader(fp):
-                symbol = DELETED_POINT_SYMBOLS.get(rec["Kl"], "other")
+            columns = (
+                "Punktnummer",
+                "X [LV95]",
+                "Y [LV95]",
+                "Kl",
+                "Erstellmutation",
+                "Löschmutation",
+            )
+            for id, x, y, kl, created_by, deleted_by in read_csv(fp, columns):
                 points.append(
                     DeletedPoint(
-                        id=rec["Punktnummer"],
-                        x=float(rec["X [LV95]"]),
-                        y=float(rec["Y [LV95]"]),
-                        symbol=symbol,
-                        created_by=rec["Erstellmutation"],
-                        deleted_by=rec["Löschmutation"],
+                        id=id,
+                        x=float(x),
+                        y=float(y),
+                        symbol=DELETED_POINT_SYMBOLS.get(kl, "other"),
+                        created_by=created_by,
+                        deleted_by=deleted_by,
                     )
                 )
         return points
@@ -388,70 +450,50 @@ class Georeferencer(object):
     def _read_border_points():
         path = os.path.join("survey_data", "border_points.csv")
         with open(path) as fp:
-            for rec in csv.DictReader(fp):
-                if symbol := BORDER_POINT_SYMBOLS.get(rec["type"]):
+            columns = ("point", "type", "x", "y", "created")
+            for id, point_type, x, y, created in read_csv(fp, columns):
+                if symbol := BORDER_POINT_SYMBOLS.get(point_type):
                     yield BorderPoint(
-                        id=rec["point"],
+                        id=id,
                         symbol=symbol,
-                        x=float(rec["x"]),
-                        y=float(rec["y"]),
-                        created=rec["created"],
+                        x=float(x),
+                        y=float(y),
+                        created=created,
                     )
 
     @staticmethod
     def _read_fixed_points():
         path = os.path.join("survey_data", "fixed_points.csv")
         with open(path) as fp:
-            for rec in csv.DictReader(fp):
+            columns = ("point", "x", "y", "created")
+            for id, x, y, created in read_csv(fp, columns):
                 yield FixedPoint(
-                    id=rec["point"],
+                    id=id,
                     symbol="double_white_circle",
-                    x=float(rec["x"]),
-                    y=float(rec["y"]),
-                    created=rec["created"],
+                    x=float(x),
+                    y=float(y),
+                    created=created,
                 )
 
     @staticmethod
     def _build_quad_tree(points):
-        min_x, max_x = min(p.x for p in points), max(p.x for p in points)
-        min_y, max_y = min(p.y for p in points), max(p.y for p in points)
-        width, height = max_x - min_x, max_y - min_y
-        center_x, center_y = min_x + width / 2.0, min_y + height / 2.0
-        tree = quads.QuadTree(
-            center=(center_x, center_y),
-            width=width + 1.0,
-            height=height + 1.0,
-        )
-        for p in points:
-            tree.insert((p.x, p.y), data=p)
-        return tree
-
-    def _mutation_parcels(self, tiff):
-        parcels = set()
-        for page_num in range(tiff.n_frames):
-            tiff.seek(page_num)
-            meta = json.loads(tiff.tag_v2[270])
-            parcels.update(meta.get("parcels", []))
-        return parcels
+        return QuadTree(points)
 
-    def _mutation_bbox(self, mutation, tiff, ocr_parcels):
+    def _mutation_bbox(self, tiff_meta, ocr_parcels):
         boxes = []
-        meta = json.loads(tiff.tag_v2[270])
+        meta = tiff_meta.pages[0]
 
         # Sometimes we know a mutation's coordinates from survey data,
         # such as when the current survey data contains border points
         # that have been created by a mutation.
         m = self.mutations.get(meta["mutation"])
-        if m is not None and m.min_x:
-            boxes.append(m)
+        if m is not None and m.min_x is not None:
+            boxes.append((m.min_x, m.max_x, m.min_y, m.max_y))
 
         # Another source for coordinates is the parcels that were
         # created by the mutation; some of the newly created parcels
         # may still exist today.
-        for parcel in self._mutation_parcels(tiff):
-            p = self.parcels.get(parcel)
-            if p is not None and p.min_x:
-                boxes.append(p)
+        boxes.extend(self.parcels.bboxes(tiff_meta.parcels))
 
         # Also, the mutation PDF may contain parcel names which
         # have been extracted from OCR. For example, newer plans
@@ -462,16 +504,14 @@ class Georeferencer(object):
         # annotations, we the OCRed parcel names only if we have
         # no better data source.
         if len(boxes) == 0:
-            for parcel in ocr_parcels:
-                p = self.parcels.get(parcel)
-                if p is not None and p.min_x:
-                    boxes.append(p)
+            boxes.extend(self.parcels.bboxes(ocr_parcels))
 
         if len(boxes) > 0:
-            min_x = min(b.min_x for b in boxes)
-            max_x = max(b.max_x for b in boxes)
-            min_y = min(b.min_y for b in boxes)
-            max_y = max(b.max_y for b in boxes)
+            # Swiss LV95 coordinates are in the millions, so we need
+            # float64 to keep sub-meter precision.
+            b = numpy.asarray(boxes, dtype=numpy.float64)
+            min_x, max_x = float(b[:, 0].min()), float(b[:, 1].max())
+            min_y, max_y = float(b[:, 2].min()), float(b[:, 3].max())
             return (min_x, max_x, min_y, max_y)
         else:
             return None
@@ -528,7 +568,7 @@ class Georeferencer(object):
         return screenshots
 
     def _detect_map_symbols(self, _mutation, thresh, scale):
-        page = numpy.asarray(thresh).astype(numpy.uint8) * 255
+        page = bilevel_to_array(thresh)
         # Our classifier sometimes gets confused if the outermost
         # pixels aren't white. Draw a one-pixel white line around
         # the plan.
@@ -572,5 +612,19 @@ if __name__ == "__main__":
     mutations = set(f.rsplit(".", 1)[0] for f in os.listdir("rendered"))
     # mutations = {m for m in mutations if m[0] not in {"2", "3"}}
     # mutations = {m for m in mutations if m.startswith("AR")}
-    for mut in sorted(mutations):
-        ref.georeference(mut)
+    mutations = sorted(mutations)
+
+    # Thresholding is mostly spent in OpenCV and libtiff, which release
+    # the Python interpreter lock. So we threshold the next mutation
+    # in a background thread while georeferencing the current one.
+    def prefetch(mut):
+        if not os.path.exists(os.path.join(ref.out_dir, f"{mut}.log")):
+            ref.threshold(mut)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+        pending = [prefetcher.submit(prefetch, m) for m in mutations[:1]]
+        for i, mut in enumerate(mutations):
+            if i + 1 < len(mutations):
+                pending.append(prefetcher.submit(prefetch, mutations[i + 1]))
+            pending.pop(0).result()
+            ref.georeference(mut)
@@ -6,20 +6,21 @@
 # database of 2007 (the earliest digitially available year). Some others
 # we take from the configuration file in src/mutation_dates.csv.
 
-import csv
 import os
 
+from util import read_csv
+
 
 def _read_mutation_dates():
     dates = {}
     root = os.path.join(os.path.dirname(__file__), "..")
     with open(os.path.join(root, "src", "mutation_dates.csv")) as fp:
-        for row in csv.DictReader(fp):
-            dates[row["mutation"]] = row["date"]
+        for mutation, date in read_csv(fp, ("mutation", "date")):
+            dates[mutation] = date
     with open(os.path.join(root, "survey_data", "mutations.csv")) as fp:
-        for row in csv.DictReader(fp):
-            if d := row["date"]:
-                dates[row["mutation"]] = d
+        for mutation, date in read_csv(fp, ("mutation", "date")):
+            if date:
+                dates[mutation] = date
     return dates
 
 
@@ -2,6 +2,8 @@
 # SPDX-License-Identifier: MIT
 
 import argparse
+import collections
+import concurrent.futures
 import csv
 import datetime
 import io
@@ -10,24 +12,39 @@ import math
 import multiprocessing
 import os
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
 import traceback
 
 import cv2
-import numpy
 import PIL.Image
 
 from classify import detect_map_symbols
 from mutation_dates import dates as mutation_dates
 import survey_data
 from threshold import threshold
-from util import din_format
+from util import bilevel_to_array, din_format
+
+# Resolution in dots per inch for rendering the scanned PDFs.
+RENDER_DPI = 300
 
 # Regular expression to extract mutaton dates.
 DATE_PATTERN = re.compile(r".+_[jJ](\d{4})([-_](\d{2})[-_](\d{2}))?.*\.pdf$")
 
+# Regular expressions to extract mutation numbers from scan filenames.
+MUTATION_NUMBER_PATTERN = re.compile(r"^([A-Z]{2})?(\d+)")
+K_MUTATION_NUMBER_PATTERN = re.compile(r"^[kK][-_](\d+)")
+
+# Regular expression to extract map scales such as "1:500" from OCR text.
+SCALE_PATTERN = re.compile(r"\s+1\s*:(200|500|1000|2000|5000)\s+")
+
+# Regular expressions to extract parcel numbers from OCR text
+# and from scan filenames.
+PARCEL_PATTERN = re.compile(r"\b([23]\d{4}|[A-Z]{2}\d+)\b")
+SCAN_PARCEL_PATTERN = re.compile(r"[A-Z]{2}\d+")
+
 
 class Mutation(object):
     def __init__(self, id, date, scans, cadaref_tool, workdir):
@@ -44,6 +61,9 @@ class Mutation(object):
         # so we need to set this global configuration here, in the per-process
         # runner.
         PIL.Image.MAX_IMAGE_PIXELS = None
+        # Every core already runs a worker process of its own, so OpenCV
+        # should not start additional threads for parallelizing its work.
+        cv2.setNumThreads(1)
         print(f"START {self.id}")
         status = self.do_process()
         print(f"FINISHED {self.id} {status}")
@@ -94,20 +114,29 @@ class Mutation(object):
     def pdf_to_text(self):
         text_path = os.path.join(self.workdir, "text", f"{self.id}.txt")
         if not os.path.exists(text_path):
-            pages = []
-            for pdf_path in self.scans:
-                proc = subprocess.run(
-                    ["pdftotext", "-layout", pdf_path, "-"],
-                    capture_output=True,
-                )
-                assert proc.returncode == 0, (pdf_path, proc.returncode)
-                text = proc.stdout.decode("utf-8").rstrip("\u000C")
-                pages.extend(text.split("\u000C"))
-            with open(text_path + ".tmp", "w") as fp:
-                fp.write("\u000C".join(pages))  # not an atomic operation
-            os.rename(text_path + ".tmp", text_path)  # atomic operation
+            # The scans of a mutation are independent of each other,
+            # so we extract their text concurrently. Each pdftotext
+            # process writes into its own file, which we concatenate
+            # without decoding. Since pdftotext terminates every page
+            # with a form feed, the pages of all scans stay separated.
+            parts = [f"{text_path}.{i}.tmp" for i in range(len(self.scans))]
+            cmds = [
+                ["pdftotext", "-layout", pdf_path, part_path]
+                for pdf_path, part_path in zip(self.scans, parts)
+            ]
+            try:
+                run_processes(cmds, stderr=subprocess.DEVNULL)
+                with open(text_path + ".tmp", "wb") as fp:  # not atomic
+                    for part_path in parts:
+                        with open(part_path, "rb") as part:
+                            shutil.copyfileobj(part, fp)
+                os.rename(text_path + ".tmp", text_path)  # atomic operation
+            finally:
+                for path in parts + [text_path + ".tmp"]:
+                    if os.path.exists(path):
+                        os.remove(path)
         with open(text_path, "r") as fp:
-            text = fp.read()
+            text = fp.read().removesuffix("\u000C")
             pages = text.split("\u000C")
         self.log.write("Text: %d characters, %d pages\n" % (len(text), len(pages)))
         self.log_stage_completion("text")
@@ -119,17 +148,18 @@ class Mutation(object):
             return tiff_path
         tmp_dir = os.path.join(self.workdir, "tmp")
         with tempfile.TemporaryDirectory(dir=tmp_dir) as temp:
+            # Each scan gets rendered into its own set of files,
+            # so we can render several scans concurrently.
+            cmds = []
             for i, pdf_path in enumerate(self.scans):
                 target = os.path.join(temp, f"S{i+1}")
-                proc = subprocess.run(
-                    ["pdftocairo", "-tiff", "-r", "300", pdf_path, target]
-                )
-                assert proc.returncode == 0, (pdf_path, proc.returncode)
+                cmd = ["pdftocairo", "-tiff", "-r", str(RENDER_DPI), pdf_path, target]
+                cmds.append(cmd)
+            run_processes(cmds)
             pages = list_rendered_pages(temp)
             self.log.write("Rendered: %d pages\n" % len(pages))
             if self.date:
-                for page in pages:
-                    self.set_tiff_date(page)
+                self.set_tiff_dates(pages)
             assert len(pages) == len(text), self.id
             split_pages, split_text = [], []
             for page_path, page_text in zip(pages, text):
@@ -157,10 +187,20 @@ class Mutation(object):
         self.log_stage_completion("rendered")
         return tiff_path
 
-    def set_tiff_date(self, path):
+    def set_tiff_dates(self, paths):
         tiff_date = self.date.replace("-", ":") + " 00:00:00"
-        proc = subprocess.run(["tiffset", "-s", "306", tiff_date, path])
-        assert proc.returncode == 0, (path, proc.returncode)
+
+        def set_date(path):
+            proc = subprocess.run(["tiffset", "-s", "306", tiff_date, path])
+            assert proc.returncode == 0, (path, proc.returncode)
+
+        # tiffset modifies a single file per invocation, but the pages
+        # are independent files, so we can update several concurrently.
+        # Since this runs in every worker of our process pool, we limit
+        # the number of tiffset processes per worker.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            for _ in executor.map(set_date, paths):
+                pass
 
     def threshold(self):
         path = os.path.join(self.workdir, "thresholded", f"{self.id}.tif")
@@ -174,15 +214,16 @@ class Mutation(object):
         return path
 
     def extract_map_scales(self, text):
-        result = []
-        scale_re = re.compile(r"\s+1\s*:(200|500|1000|2000|5000)\s+")
-        all_scales = list(sorted(set(scale_re.findall(" ".join(text)))))
+        # Joining the pages with a space lets the pattern also match
+        # scales at the very start or end of a page, so the scales
+        # of the entire mutation are not just the per-page union.
+        all_scales = list(sorted(set(SCALE_PATTERN.findall(" ".join(text)))))
         if len(all_scales) == 0:
             all_scales = [200, 500]  # defaults if OCR cannot find any scales
+        result = []
         for page in text:
-            page_scales = list(sorted(set(scale_re.findall(page))))
-            page_scales = page_scales or all_scales
-            result.append(page_scales)
+            page_scales = list(sorted(set(SCALE_PATTERN.findall(page))))
+            result.append(page_scales or all_scales)
         for page_num, scales in enumerate(result):
             sc = ",".join([f"1:{s}" for s in scales])
             self.log.write(f"MapScale: page={page_num+1} scales={sc}\n")
@@ -210,9 +251,11 @@ class Mutation(object):
         return max(limits)
 
     def extract_parcels(self, text):
-        p = set(re.findall(r"\b([23]\d{4}|[A-Z]{2}\d+)\b", "\n".join(text)))
+        p = set()
+        for page in text:
+            p.update(PARCEL_PATTERN.findall(page))
         for path in self.scans:
-            p.update(set(re.findall(r"[A-Z]{2}\d+", path)))
+            p.update(SCAN_PARCEL_PATTERN.findall(path))
         self.log.write("Parcels: %s\n" % ",".join(sorted(p)))
         return p
 
@@ -273,23 +316,21 @@ class Mutation(object):
         if os.path.exists(sym_path):
             return self.read_symbols(sym_path)
         symbols = []
-        r_path = os.path.join(self.workdir, "rendered", f"{self.id}.tif")
         t_path = os.path.join(self.workdir, "thresholded", f"{self.id}.tif")
-        with PIL.Image.open(r_path) as rendered:
-            with PIL.Image.open(t_path) as thresholded:
-                for page_num in range(rendered.n_frames):
-                    # Skip screenshots. page_num is 0-based.
-                    if page_num + 1 in screenshots:
-                        continue
-                    rendered.seek(page_num)
-                    thresholded.seek(page_num)
-                    rendered_dpi = float(rendered.info["dpi"][0])
-                    thresholded_dpi = float(thresholded.info["dpi"][0])
-                    scale = rendered_dpi / thresholded_dpi
-                    s = self.detect_map_symbols_on_page(thresholded, scale)
-                    for x, y, sym in s:
-                        symbols.append((page_num + 1, x, y, sym))
-                    self.log.write(f"Symbols: page={page_num+1} n={len(s)}\n")
+        # Symbol positions refer to the rendered image, which always has
+        # RENDER_DPI, so we do not need to open the rendered image here.
+        with PIL.Image.open(t_path) as thresholded:
+            for page_num in range(thresholded.n_frames):
+                # Skip screenshots. page_num is 0-based.
+                if page_num + 1 in screenshots:
+                    continue
+                thresholded.seek(page_num)
+                thresholded_dpi = float(thresholded.info["dpi"][0])
+                scale = RENDER_DPI / thresholded_dpi
+                s = self.detect_map_symbols_on_page(thresholded, scale)
+                for x, y, sym in s:
+                    symbols.append((page_num + 1, x, y, sym))
+                self.log.write(f"Symbols: page={page_num+1} n={len(s)}\n")
         symbols.sort()
         tmp_path = sym_path + ".tmp"
         with open(tmp_path, "w") as fp:
@@ -313,7 +354,7 @@ class Mutation(object):
         return {page: syms for page, syms in syms.items() if len(syms) >= 4}
 
     def detect_map_symbols_on_page(self, image, scale):
-        page = numpy.asarray(image).astype(numpy.uint8) * 255
+        page = bilevel_to_array(image)
 
         # At the moment, detection of white symbols is much
         # more reliable than detection of black symbols (mainly
@@ -554,7 +595,9 @@ def process_batch(scans, cadaref_tool, workdir):
     ):
         os.makedirs(os.path.join(workdir, dirname), exist_ok=True)
     work = find_work(scans, cadaref_tool, workdir)
-    with multiprocessing.Pool() as pool:
+    # Restart worker processes from time to time, so memory held
+    # by PIL and OpenCV for huge scans gets returned to the system.
+    with multiprocessing.Pool(maxtasksperchild=4) as pool:
         for _ in pool.imap_unordered(Mutation.process, work):
             pass
 
@@ -567,18 +610,14 @@ def find_work(scans, cadaref_tool, workdir):
     unexpected_filenames = set()
     dates = {}  # mutation id -> date
     paths = {}  # mutation id -> [path to pdf, path to pdf, ...]
-    for dirpath, _, filenames in os.walk(scans):
-        for name in filenames:
-            path = os.path.join(dirpath, name)
-            if not name.endswith(".pdf"):
-                continue
-            id = extract_mutation_id(name)
-            if not id:
-                unexpected_filenames.add(path)
-                continue
-            paths.setdefault(id, []).append(path)
-            date = mutation_dates.get(id, extract_mutation_date(name))
-            dates.setdefault(id, date)
+    for entry in list_pdf_files(scans):
+        id = extract_mutation_id(entry.name)
+        if not id:
+            unexpected_filenames.add(entry.path)
+            continue
+        paths.setdefault(id, []).append(entry.path)
+        date = mutation_dates.get(id, extract_mutation_date(entry.name))
+        dates.setdefault(id, date)
     for id in sorted(paths.keys()):
         if id not in done:
             work.append(Mutation(id, dates.get(id), paths[id], cadaref_tool, workdir))
@@ -593,25 +632,58 @@ def find_work(scans, cadaref_tool, workdir):
     return work
 
 
+# Yields a DirEntry for every PDF file in a directory tree. Unlike
+# os.walk(), os.scandir() tells us the file type without extra stat()
+# calls, which matters when the scans are on a network file system.
+# For the same reason, we list directories on a pool of threads, so
+# the latencies of the file server overlap. Directories are visited
+# in breadth-first order, independent of when their listing arrives.
+def list_pdf_files(dirpath):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        pending = collections.deque([executor.submit(_scan_dir, dirpath)])
+        while pending:
+            files, subdirs = pending.popleft().result()
+            pending.extend(executor.submit(_scan_dir, d) for d in subdirs)
+            yield from files
+
+
+def _scan_dir(dirpath):
+    files, subdirs = [], []
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.endswith(".pdf"):
+                files.append(entry)
+    return files, subdirs
+
+
 # "AF_Mut_20009_Kat_AF5146_AF5147_j2005.pdf" --> "20009"
 # "FL_Mut_1303_Kat_588_J1959_01-01.pdf" --> "FL1303"
 def extract_mutation_id(filename):
-    split = filename.split("_Mut_")
-    if len(split) < 2:
+    prefix, sep, rest = filename.partition("_Mut_")
+    if not sep:
         return None
-    # "FB" = "Flächenbereinigung" (area correction), not a neighborhood
-    neighborhoods = list({x.strip() for x in split[0].split("_") if x != "FB"})
-    if m := re.match(r"^([A-Z]{2})?(\d+)", split[1]):
+    if m := MUTATION_NUMBER_PATTERN.match(rest):
         num = int(m.group(2))
         if num >= 20000:
             return str(num)
         else:
-            return "%s%d" % (neighborhoods[0], num)
-    if m := re.match(r"^[kK][-_](\d+)", split[1]):
-        return "%s-K%d" % (neighborhoods[0], int(m.group(1)))
+            return "%s%d" % (extract_neighborhood(prefix), num)
+    if m := K_MUTATION_NUMBER_PATTERN.match(rest):
+        return "%s-K%d" % (extract_neighborhood(prefix), int(m.group(1)))
     return None
 
 
+# "AF" --> "AF"
+# "FB_HG" --> "HG"
+def extract_neighborhood(prefix):
+    # "FB" = "Flächenbereinigung" (area correction), not a neighborhood.
+    # When a filename names several neighborhoods, we take the first one,
+    # so that the mutation ID does not depend on Python's hash seed.
+    return next(x.strip() for x in prefix.split("_") if x != "FB")
+
+
 # "AF_Mut_20009_Kat_AF5146_AF5147_j2005.pdf" --> "2005-01-01"
 # "FL_Mut_1303_Kat_588_J1959_01-01.pdf" --> "1959-01-01"
 def extract_mutation_date(filename):
@@ -630,6 +702,35 @@ def extract_mutation_date(filename):
 PDFCAIRO_FILENAME_PATTERN = re.compile(r"^S(\d+)-(\d+)\.tif$")
 
 
+# Runs the given commands as child processes, with at most max_running
+# of them at the same time. Since every worker of our process pool runs
+# one mutation, a mutation with many scans would otherwise start dozens
+# of processes per core. If a command fails, the others still running
+# get killed before the assertion error reaches the caller.
+def run_processes(cmds, max_running=4, stderr=None):
+    pending, running = collections.deque(cmds), collections.deque()
+    try:
+        while pending or running:
+            while pending and len(running) < max_running:
+                cmd = pending.popleft()
+                running.append((cmd, subprocess.Popen(cmd, stderr=stderr)))
+            cmd, proc = running.popleft()
+            returncode = proc.wait()
+            assert returncode == 0, (cmd, returncode)
+    finally:
+        kill_processes([proc for _, proc in running])
+
+
+# Kills any of the given child processes that are still running,
+# and waits for all of them to terminate.
+def kill_processes(procs):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.kill()
+    for proc in procs:
+        proc.wait()
+
+
 def list_rendered_pages(dirpath):
     pages = []
     for f in os.listdir(dirpath):
@@ -0,0 +1,109 @@
+# SPDX-FileCopyrightText: 2024 Sascha Brawer <sascha@brawer.ch>
+# SPDX-License-Identifier: MIT
+
+# Static spatial index for answering bounding box queries over a large
+# set of geographic points, such as all border points of Zürich.
+#
+# Instead of inserting points one by one into a tree of Python objects,
+# we bulk-build a "virtual" quadtree: coordinates get quantized to a grid
+# of 2^16 x 2^16 cells, each point is assigned the Morton code (Z-order)
+# of its grid cell, and the points are sorted by their code. In Morton
+# order, every node of the quadtree covers a contiguous range of the
+# sorted array, so the tree structure never needs to be materialized;
+# when answering a query, we find the points of a node by binary search.
+
+import math
+
+import numpy
+
+# Number of quadtree levels. Coordinates get quantized to 2^LEVELS cells
+# along each axis, so the Morton codes fit into 2 * LEVELS bits.
+LEVELS = 16
+
+# When a query partially overlaps a quadtree node with at most this
+# many points, we check the points individually instead of descending
+# further into the tree.
+LEAF_SIZE = 16
+
+
+class QuadTree(object):
+    def __init__(self, points):
+        self.points = points
+        n = len(points)
+        xs = numpy.fromiter((p.x for p in points), dtype=numpy.float64, count=n)
+        ys = numpy.fromiter((p.y for p in points), dtype=numpy.float64, count=n)
+        self.min_x, self.min_y = float(xs.min()), float(ys.min())
+        extent = max(float(xs.max()) - self.min_x, float(ys.max()) - self.min_y)
+        self.scale = ((1 << LEVELS) - 1) / extent if extent > 0 else 1.0
+        qx = ((xs - self.min_x) * self.scale).astype(numpy.int64)
+        qy = ((ys - self.min_y) * self.scale).astype(numpy.int64)
+        codes = _spread_bits(qx) | (_spread_bits(qy) << 1)
+        self.order = numpy.argsort(codes, kind="stable")
+        self.codes = codes[self.order]
+        self.xs = xs[self.order]
+        self.ys = ys[self.order]
+
+    # Returns the list of points within a bounding box, given in the
+    # same (min_x, max_x, min_y, max_y) order as used elsewhere in this
+    # project. Points on the border of the box are included.
+    def within_bbox(self, min_x, max_x, min_y, max_y):
+        query = (
+            math.floor((min_x - self.min_x) * self.scale),
+            math.floor((max_x - self.min_x) * self.scale),
+            math.floor((min_y - self.min_y) * self.scale),
+            math.floor((max_y - self.min_y) * self.scale),
+        )
+        ranges, candidates = [], []
+        self._query(0, 0, 0, LEVELS, query, ranges, candidates)
+        found = [numpy.arange(lo, hi) for lo, hi in ranges]
+        for lo, hi in candidates:
+            x, y = self.xs[lo:hi], self.ys[lo:hi]
+            mask = (x >= min_x) & (x <= max_x) & (y >= min_y) & (y <= max_y)
+            found.append(lo + numpy.flatnonzero(mask))
+        if not found:
+            return []
+        indices = numpy.sort(self.order[numpy.concatenate(found)])
+        return [self.points[i] for i in indices]
+
+    # Visits the quadtree node whose lower-left grid cell is (cx, cy)
+    # and whose sides are 2^level cells long. Appends the index ranges
+    # of points that are certainly within the query to `ranges`, and
+    # the index ranges that need an exact check to `candidates`.
+    def _query(self, code, cx, cy, level, query, ranges, candidates):
+        qmin_x, qmax_x, qmin_y, qmax_y = query
+        size = 1 << level
+        if cx > qmax_x or cx + size <= qmin_x or cy > qmax_y or cy + size <= qmin_y:
+            return
+        lo, hi = numpy.searchsorted(self.codes, (code, code + size * size))
+        if lo == hi:
+            return
+        # Cells strictly between the quantized query bounds lie entirely
+        # within the query, so their points need no further check.
+        if qmin_x < cx and cx + size <= qmax_x and qmin_y < cy and cy + size <= qmax_y:
+            ranges.append((lo, hi))
+            return
+        if level == 0 or hi - lo <= LEAF_SIZE:
+            candidates.append((lo, hi))
+            return
+        half = size >> 1
+        quarter = half * half
+        for i in range(4):
+            self._query(
+                code + i * quarter,
+                cx + (i & 1) * half,
+                cy + (i >> 1) * half,
+                level - 1,
+                query,
+                ranges,
+                candidates,
+            )
+
+
+# Interleaves the bits of an array of 16-bit integers with zeros,
+# so that bit i of the input moves to bit 2*i of the output.
+def _spread_bits(v):
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+    return v
@@ -7,8 +7,13 @@
 from collections import namedtuple
 import csv
 from datetime import date, timedelta
+import functools
 import os
 
+import numpy
+
+from util import read_csv
+
 
 # Map from point classes in survey_data/border_points.csv to cartographic
 # symbols. Symbol IDs are the same as returned by detect_map_symbols()
@@ -66,6 +71,7 @@ Parcel = namedtuple(
 )
 
 
+@functools.cache
 def _read_mutations():
     mutations = {}
 
@@ -83,39 +89,57 @@ def _read_mutations():
 
     survey_data_path = os.path.join(src_path, "..", "survey_data")
     with open(os.path.join(survey_data_path, "mutations.csv")) as fp:
-        for row in csv.DictReader(fp):
+        columns = ("mutation", "min_x", "max_x", "min_y", "max_y", "date")
+        for id, min_x, max_x, min_y, max_y, d in read_csv(fp, columns):
             mutation = Mutation(
-                mutation_id=row["mutation"],
-                min_x=float(row["min_x"]) if row["min_x"] else None,
-                max_x=float(row["max_x"]) if row["max_x"] else None,
-                min_y=float(row["min_y"]) if row["min_y"] else None,
-                max_y=float(row["max_y"]) if row["max_y"] else None,
-                date=date.fromisoformat(row["date"]),
+                mutation_id=id,
+                min_x=float(min_x) if min_x else None,
+                max_x=float(max_x) if max_x else None,
+                min_y=float(min_y) if min_y else None,
+                max_y=float(max_y) if max_y else None,
+                date=date.fromisoformat(d),
             )
-            mutations[mutation.mutation_id] = mutation
+            mutations[id] = mutation
     return mutations
 
 
+@functools.cache
 def _read_parcels():
     parcels = {}
     survey_data = os.path.join(os.path.dirname(__file__), "..", "survey_data")
     with open(os.path.join(survey_data, "parcels.csv")) as fp:
-        for row in csv.DictReader(fp):
-            parcel = Parcel(
-                parcel_id=row["parcel"],
-                min_x=float(row["min_x"]),
-                max_x=float(row["max_x"]),
-                min_y=float(row["min_y"]),
-                max_y=float(row["max_y"]),
-                created_by=row["created_by"],
-                created=date.fromisoformat(row["created"]),
+        columns = (
+            "parcel",
+            "min_x",
+            "max_x",
+            "min_y",
+            "max_y",
+            "created_by",
+            "created",
+        )
+        for row in read_csv(fp, columns):
+            id, min_x, max_x, min_y, max_y, created_by, created = row
+            parcels[id] = Parcel(
+                parcel_id=id,
+                min_x=float(min_x),
+                max_x=float(max_x),
+                min_y=float(min_y),
+                max_y=float(max_y),
+                created_by=created_by,
+                created=date.fromisoformat(created),
             )
-            parcels[parcel.parcel_id] = parcel
     return parcels
 
 
-parcels = _read_parcels()
-mutations = _read_mutations()
+# The module attributes `parcels` and `mutations` get loaded lazily
+# on first access (PEP 562), so that importing this module is cheap
+# for callers and worker processes that never look at them.
+def __getattr__(name):
+    if name == "parcels":
+        return _read_parcels()
+    if name == "mutations":
+        return _read_mutations()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def make_geojson(f):
@@ -134,9 +158,9 @@ def make_geojson(f):
             ],
         },
     }
-    if type(f) == Parcel and f.parcel_id:
+    if isinstance(f, Parcel) and f.parcel_id:
         feature["id"] = f.parcel_id
-    elif type(f) == Mutation and f.mutation_id:
+    elif isinstance(f, Mutation) and f.mutation_id:
         feature["id"] = f.mutation_id
     return feature
 
@@ -150,54 +174,86 @@ def read_points(min_x, min_y, max_x, max_y, map_date):
     # So we allow for 1 years of slack when comparing dates.
     date_slack = timedelta(days=365)
 
-    survey_data = os.path.join(os.path.dirname(__file__), "..", "survey_data")
-    with open(os.path.join(survey_data, "border_points.csv")) as fp:
-        for row in csv.DictReader(fp):
-            point_id = row["point"]
-            symbol = BORDER_POINT_SYMBOLS.get(row["type"], "")
-            if "white" not in symbol:
-                continue
-            x, y = float(row["x"]), float(row["y"])
-            if not (min_x <= x <= max_x and min_y <= y <= max_y):
-                continue
-            if map_date:
-                created = date.fromisoformat(row["created"])
-                if created > map_date + date_slack:
-                    continue
-            yield (point_id, x, y, symbol)
+    for table in _read_point_tables():
+        xs, ys = table.xs, table.ys
+        mask = (xs >= min_x) & (xs <= max_x) & (ys >= min_y) & (ys <= max_y)
+        if map_date:
+            mask &= table.created <= (map_date + date_slack).toordinal()
+            mask &= table.deleted >= (map_date - date_slack).toordinal()
+        for i in numpy.flatnonzero(mask):
+            yield (table.ids[i], float(xs[i]), float(ys[i]), table.symbols[i])
 
-    with open(os.path.join(survey_data, "fixed_points.csv")) as fp:
-        for row in csv.DictReader(fp):
-            point_id = row["point"]
-            symbol = FIXED_POINT_SYMBOLS.get(row["type"], "")
-            if "white" not in symbol:
-                continue
-            x, y = float(row["x"]), float(row["y"])
-            if not (min_x <= x <= max_x and min_y <= y <= max_y):
-                continue
-            if map_date:
-                created = date.fromisoformat(row["created"])
-                if created > map_date + date_slack:
+
+# Survey points with a white circle symbol, which are the only ones
+# returned by read_points(). The coordinates and dates are kept in
+# NumPy arrays, so each call to read_points() needs just a few vectorized
+# comparisons instead of parsing several hundred thousand CSV rows.
+# Dates are stored as ordinals; a point with unknown creation or deletion
+# date gets an ordinal that never filters it out.
+PointTable = namedtuple(
+    "PointTable", ["ids", "xs", "ys", "symbols", "created", "deleted"]
+)
+
+
+def _make_point_table(points):
+    if points:
+        ids, xs, ys, symbols, created, deleted = zip(*points)
+    else:
+        ids, xs, ys, symbols, created, deleted = (), (), (), (), (), ()
+    return PointTable(
+        ids=ids,
+        xs=numpy.array(xs, dtype=numpy.float64),
+        ys=numpy.array(ys, dtype=numpy.float64),
+        symbols=symbols,
+        created=numpy.array(created, dtype=numpy.int64),
+        deleted=numpy.array(deleted, dtype=numpy.int64),
+    )
+
+
+@functools.cache
+def _read_point_tables():
+    never_created, never_deleted = date.min.toordinal(), date.max.toordinal()
+    survey_data = os.path.join(os.path.dirname(__file__), "..", "survey_data")
+    tables = []
+    for filename, symbols in (
+        ("border_points.csv", BORDER_POINT_SYMBOLS),
+        ("fixed_points.csv", FIXED_POINT_SYMBOLS),
+    ):
+        points = []
+        with open(os.path.join(survey_data, filename)) as fp:
+            columns = ("point", "type", "x", "y", "created")
+            for point_id, point_type, x, y, created in read_csv(fp, columns):
+                symbol = symbols.get(point_type, "")
+                if "white" not in symbol:
                     continue
-            yield (point_id, x, y, symbol)
+                created = date.fromisoformat(created).toordinal()
+                points.append(
+                    (point_id, float(x), float(y), symbol, created, never_deleted)
+                )
+        tables.append(_make_point_table(points))
 
+    points = []
+    mutations = _read_mutations()
     src_path = os.path.dirname(__file__)
     with open(os.path.join(src_path, "deleted_points.csv")) as fp:
-        for row in csv.DictReader(fp):
-            created, deleted = None, None
-            if mut := mutations.get(row["Erstellmutation"]):
-                created = mut.date
-            if mut := mutations.get(row["Löschmutation"]):
-                deleted = mut.date
-            point_id = row["Punktnummer"]
-            symbol = DELETED_POINT_SYMBOLS.get(row["Kl"], "")
+        columns = (
+            "Punktnummer",
+            "Kl",
+            "X [LV95]",
+            "Y [LV95]",
+            "Erstellmutation",
+            "Löschmutation",
+        )
+        for row in read_csv(fp, columns):
+            point_id, kl, x, y, created_by, deleted_by = row
+            symbol = DELETED_POINT_SYMBOLS.get(kl, "")
             if "white" not in symbol:
                 continue
-            x, y = float(row["X [LV95]"]), float(row["Y [LV95]"])
-            if not (min_x <= x <= max_x and min_y <= y <= max_y):
-                continue
-            if created and map_date and created > map_date + date_slack:
-                continue
-            if deleted and map_date and deleted < map_date - date_slack:
-                continue
-            yield (point_id, x, y, symbol)
+            created, deleted = never_created, never_deleted
+            if mut := mutations.get(created_by):
+                created = mut.date.toordinal()
+            if mut := mutations.get(deleted_by):
+                deleted = mut.date.toordinal()
+            points.append((point_id, float(x), float(y), symbol, created, deleted))
+    tables.append(_make_point_table(points))
+    return tables
@@ -14,6 +14,7 @@
 # the type of input we’re seeing with scanned cadastral plans.
 
 import json
+import multiprocessing
 import os
 import subprocess
 import tempfile
@@ -58,9 +59,18 @@ def threshold_page(in_path, tiff, page_num):
     out_width = int(page.shape[1] * OUTPUT_DPI / x_dpi + 0.5)
     out_height = int(page.shape[0] * OUTPUT_DPI / y_dpi + 0.5)
     out_size = (out_width, out_height)
+    # At 600 dpi, every intermediate image takes hundreds of megabytes.
+    # To limit peak memory use, we release each of them as soon as
+    # it is not needed anymore.
     scaled = cv2.resize(page, out_size, interpolation=cv2.INTER_LINEAR)
+    del page
     blurred = cv2.bilateralFilter(scaled, 9, 75, 75)
-    gray = cv2.cvtColor(blurred, cv2.COLOR_BGR2GRAY)
+    del scaled
+    if blurred.ndim == 3:
+        gray = cv2.cvtColor(blurred, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = blurred  # input is already single-channel
+    del blurred
     t, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
     meta["thresholding"] = {
         "threshold": t,
@@ -82,6 +92,7 @@ def threshold_page(in_path, tiff, page_num):
             "method": "cv2.BINARY",
         }
         t, thresh = cv2.threshold(gray, new_t, 255, cv2.THRESH_BINARY)
+    del gray
 
     # Remove small speckles.
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
@@ -92,7 +103,11 @@ def threshold_page(in_path, tiff, page_num):
     # contour detection) sometimes gets confused.
     cv2.rectangle(thresh, (0, 0), (out_width - 1, out_height - 1), color=255)
 
-    bw = PIL.Image.fromarray(thresh).convert("1")
+    # Packing the bits with numpy is several times faster than
+    # PIL’s convert("1"), which runs a dithering pass over the image.
+    # PIL stores bilevel images with 1 for white, like packbits().
+    packed = numpy.packbits(thresh, axis=1)
+    bw = PIL.Image.frombytes("1", (out_width, out_height), packed.tobytes())
     bw.encoderconfig = ()
     bw.encoderinfo = {
         "compression": "group4",
@@ -109,12 +124,23 @@ def threshold_page(in_path, tiff, page_num):
     return bw
 
 
-if __name__ == "__main__":
+def threshold_file(filename):
+    # Set in the worker process, which may not have run __main__.
     PIL.Image.MAX_IMAGE_PIXELS = None
+    cv2.setNumThreads(1)
+    in_path = os.path.join("rendered", filename)
+    out_path = os.path.join("thresholded", filename)
+    if not os.path.exists(out_path):
+        threshold(in_path, "tmp", out_path + ".tmp")  # not atomic
+        os.rename(out_path + ".tmp", out_path)  # atomic
+
+
+if __name__ == "__main__":
     os.makedirs("thresholded", exist_ok=True)
     os.makedirs("tmp", exist_ok=True)
-    for f in sorted(os.listdir("rendered")):
-        in_path = os.path.join("rendered", f)
-        out_path = os.path.join("thresholded", f)
-        if not os.path.exists(out_path):
-            threshold(in_path, "tmp", out_path)
+    # Files are independent of each other, so we threshold them
+    # in parallel, one file per CPU core.
+    with multiprocessing.Pool(maxtasksperchild=4) as pool:
+        files = sorted(f for f in os.listdir("rendered") if f.endswith(".tif"))
+        for _ in pool.imap_unordered(threshold_file, files):
+            pass
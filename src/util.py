@@ -1,6 +1,11 @@
 # SPDX-FileCopyrightText: 2024 Sascha Brawer <sascha@brawer.ch>
 # SPDX-License-Identifier: MIT
 
+import csv
+import operator
+
+import numpy
+
 
 # Counts as of July 22, 2024: {'A4': 4135, 'A3R': 1177, None: 207, 'A4R': 48, 'A3': 11}
 def din_format(tiff):
@@ -13,8 +18,34 @@ def din_format(tiff):
     height_cm = tiff.height / float(dpi_y) * 2.54
     width_cm = tiff.width / float(dpi_x) * 2.54
     for name, w, h in formats:
-        if w * 0.95 <= width_cm <= w * 1.05 and h * 0.05 <= height_cm <= h * 1.05:
+        if w * 0.95 <= width_cm <= w * 1.05 and h * 0.95 <= height_cm <= h * 1.05:
             return name
-        if h * 0.95 <= width_cm <= h * 1.05 and w * 0.05 <= height_cm <= w * 1.05:
+        if h * 0.95 <= width_cm <= h * 1.05 and w * 0.95 <= height_cm <= w * 1.05:
             return name + "R"  # rotated by 90 degrees
     return None
+
+
+def bilevel_to_array(image):
+    """Returns a uint8 array with 0 for black and 255 for white pixels."""
+    # Internally, PIL stores bilevel images with one byte per pixel,
+    # using 0 for black and 255 for white. Exporting the raw bytes in
+    # mode "L" therefore gives us the pixel values without any conversion.
+    # Callers draw into the array, so we return a writable copy of them.
+    data = numpy.frombuffer(image.tobytes("raw", "L"), dtype=numpy.uint8)
+    return data.reshape(image.height, image.width).copy()
+
+
+def read_csv(fp, columns):
+    """Returns an iterator over tuples with the given columns of each CSV row."""
+    # This picks the values by their index in the header row, which is
+    # much faster than csv.DictReader with its dict for every row. Some
+    # of our callers read hundreds of thousands of rows, and others run
+    # in every spawned worker process.
+    rows = csv.reader(fp)
+    header = next(rows)
+    indices = [header.index(c) for c in columns]
+    if len(indices) == 1:
+        # For a single index, itemgetter would return a bare value.
+        index = indices[0]
+        return ((row[index],) for row in rows)
+    return map(operator.itemgetter(*indices), rows)